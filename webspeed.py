@@ -9,6 +9,7 @@ Uses a line delimited input file of domains and prints to stdout or a json file
     -The HTTP response code
     -The number of redirects the request went through
     -If 200 OK is received, content load time of the web site in seconds
+    -If testing the host failed, the error that stopped it
 
 Multi-threading for both overall website testing and for TCP time and content load testing is available in separate
  specified thread amounts.
@@ -24,19 +25,159 @@ Command line options:
 Required nonstandard modules:
     requests
 
+Optional nonstandard modules:
+    orjson              faster json output, falls back to the standard json module
+
 Example usage:
     python3 TestPerformanceReport -i <INPUT_FILE> [OPTIONS]
 """
 
-from optparse import OptionParser
+import argparse
 import socket
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import create_connection
+import idna
 import json
-import queue
 import threading
 import os
-from statistics import mean
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+try:
+    from orjson import dumps as json_dumps  # optional, faster json serialization
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+_pc = time.perf_counter  # monotonic clock used for all timings, bound once for the hot timers
+thread_data = threading.local()  # per queue thread state, requests.Session is not thread safe
+
+
+def host_key(hostname):
+    """
+    Normalizes a hostname the way urllib3 does for its connections, lowercase, IDNA encoded and without a trailing
+    dot, so dns_map is keyed the same whichever way an input host is spelled
+    """
+    hostname = hostname.rstrip('.').lower()
+    if not hostname.isascii():
+        try:
+            hostname = idna.encode(hostname, strict=True, std3_rules=True).decode('ascii')
+        except idna.IDNAError:
+            pass  # urllib3 rejects the url as well, so no connection looks it up
+    return hostname
+
+
+class PinnedConnectionMixin(object):
+    """
+    Dials the IP already resolved for an input host in dns_map instead of resolving it again, so the HTTP tests
+    reach the same server as the TCP tests. The hostname of the url is still used for Host, SNI and certificates
+    """
+
+    def _new_conn(self):
+        lookup = dns_map.get(host_key(self.host))
+        if lookup is None or lookup[0] is None:  # hosts outside the input, e.g. redirect targets, resolve normally
+            return super()._new_conn()
+        try:
+            return create_connection((lookup[0], self.port), self.timeout, source_address=self.source_address,
+                                     socket_options=self.socket_options)
+        except socket.timeout as e:
+            raise ConnectTimeoutError(self, 'Connection to {} timed out'.format(self.host)) from e
+        except OSError as e:
+            raise NewConnectionError(self, 'Failed to establish a new connection: {}'.format(e)) from e
+
+
+class PinnedHTTPConnection(PinnedConnectionMixin, HTTPConnection):
+    pass
+
+
+class PinnedHTTPSConnection(PinnedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class PinnedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PinnedHTTPConnection
+
+
+class PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PinnedHTTPSConnection
+
+
+class PinnedAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connection pools use the pinned connections above
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': PinnedHTTPConnectionPool,
+                                                   'https': PinnedHTTPSConnectionPool}
+
+
+def get_session():
+    """
+    Returns the requests.Session of the calling queue thread, creating it on first use so the thread's
+    HEAD and content load requests reuse kept-alive connections instead of opening a new one each call
+    """
+    session = getattr(thread_data, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = PinnedAdapter(pool_connections=options.test_threads, pool_maxsize=options.test_threads,
+                                max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)  # redirects may land on https
+        thread_data.session = session
+    return session
+
+
+def resolve(hostname):
+    """
+    Resolves a hostname to an IPv4 address, returns the IP, the DNS resolution time and the lookup error if it failed
+    """
+    dns_start = _pc()
+    try:
+        ip_address = socket.getaddrinfo(hostname, None, family=socket.AF_INET,
+                                        type=socket.SOCK_STREAM)[0][4][0]  # DNS resolution call
+    except (OSError, UnicodeError) as e:  # unresolvable hostname, only fails the test of that host
+        return None, _pc() - dns_start, '{}: {}'.format(type(e).__name__, e)
+    return ip_address, _pc() - dns_start, None
+
+
+@dataclass(slots=True)
+class HostResult:
+    """
+    Performance output of a single host, fixed slots instead of a dict per host. Results that weren't measured,
+    because the host failed or no 200 OK was received, are left as None
+    """
+    dns_time: Optional[float] = None
+    ip: Optional[str] = None
+    avg_tcp: Optional[float] = None
+    http_code: Optional[int] = None
+    redirects: Optional[int] = None
+    avg_content: Optional[float] = None  # only measured if 200 OK is received
+    error: Optional[str] = None  # why testing the host stopped early
+
+    def to_dict(self):
+        """
+        Returns the measured results keyed by their report labels, results that weren't measured are left out
+        """
+        output = {
+            'DNS Time': self.dns_time,
+            'IP of Domain': self.ip,
+            'Average TCP Time': self.avg_tcp,
+            'HTTP Response Code': self.http_code,
+            'Number of Redirects': self.redirects,
+            'Average Content Load Time': self.avg_content,
+            'Error': self.error,
+        }
+        return {label: result for label, result in output.items() if result is not None}
 
 
 class TestPerformance(object):
@@ -45,160 +186,164 @@ class TestPerformance(object):
 
     Methods:
         tcp_time():
-            Gets tcp time
+            Returns the time of a single TCP connection, for use by test_all() test threads
         get_http():
             Gets response code, number of redirects, and content load time
         time_content():
-            For use by get_http() test threads to measure content load time
+            Returns the content load time of a response, for use by get_http() test threads
         test_all():
             Runs test using all methods to calculate performance output, used by queue threads
     """
 
     def __init__(self, hostname):
         self.hostname = hostname
-        self.performance_output = {}
-        self.c_header = {'host': self.hostname}  # custom header for requests
+        self.performance_output = HostResult()
+        self.c_header = {}  # custom header for requests, Host is derived from the url
         if options.user_agent:
             self.c_header['User-agent'] = options.user_agent
 
-        # DNS Resolution Time and IP
-        dns_start = time.time()
-        self.ip_address = socket.gethostbyname(self.hostname)  # DNS resolution call
-        dns_end = time.time()
-        self.performance_output['DNS Time'] = dns_end - dns_start
-        self.performance_output['IP of Domain'] = self.ip_address
+        # DNS Resolution Time and IP, resolved ahead of testing by main()
+        self.ip_address, dns_time, dns_error = dns_map[host_key(self.hostname)]
+        self.performance_output.dns_time = dns_time
+        self.performance_output.ip = self.ip_address
+        self.performance_output.error = dns_error
 
     def tcp_time(self):
         port = 80
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # connects via TCP
-        # Bind call skipped, so same as calling s.bind('', 0) for IP and port
-        tcp_start = time.time()
-        s.connect((self.ip_address, port))
-        tcp_end = time.time()
-        s.close()
-        self.tcp_times.append(tcp_end - tcp_start)
+        # connects via TCP, close-on-exec is set atomically where the platform supports it
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM | getattr(socket, 'SOCK_CLOEXEC', 0))
+        try:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Bind call skipped, so same as calling s.bind('', 0) for IP and port
+            tcp_start = _pc()
+            s.connect((self.ip_address, port))
+            tcp_end = _pc()
+        finally:
+            s.close()  # also closes sockets of failed connections
+        return tcp_end - tcp_start
 
     def get_http(self):
-        ip_to_url = 'http://{}/'.format(self.ip_address)  # IP format that's compatible with requests
+        # pooled per host and dialed at self.ip_address by PinnedAdapter, redirects to https are followed
+        host_url = 'http://{}/'.format(self.hostname)
+
+        session = get_session()
+        # requests are prepared once per host and sent as is for every test
+        head_request = session.prepare_request(requests.Request('HEAD', host_url, headers=self.c_header))
+        content_request = session.prepare_request(requests.Request('GET', host_url, headers=self.c_header))
+        # proxy and certificate settings from the environment, as session.request() would apply them
+        send_settings = session.merge_environment_settings(host_url, {}, None, None, None)
 
         # HTTP Response Code
-        host_head = requests.head(ip_to_url, headers=self.c_header, allow_redirects=True)  # retrievers headers
+        host_head = session.send(head_request, allow_redirects=True, **send_settings)  # retrievers headers
         host_code = host_head.status_code  # response code
-        self.performance_output['HTTP Response Code'] = host_code
+        self.performance_output.http_code = host_code
 
         # Number Redirects
-        self.performance_output['Number of Redirects'] = len(host_head.history)  # redirect history
+        self.performance_output.redirects = len(host_head.history)  # redirect history
 
         if host_code == 200:  # if 200 OK received then get content
             # Get Content
-            self.content_times = []
-            self.content_threads = []
-            for test_thread in range(options.test_threads):  # threads to use for testing
-                r = requests.get(ip_to_url, headers=self.c_header,
-                                 stream=True)  # only retrieves response headers, connection open
-                content_t = threading.Thread(target=self.time_content, args=(r,))  # retrieves content
-                content_t.start()
-                self.content_threads.append(content_t)
-            for thread in self.content_threads:  # wait until threads are finished
-                thread.join()
-            self.performance_output['Average Content Load Time'] = mean(self.content_times)
+            send_settings['stream'] = True  # only retrieves response headers, connection open
+            responses = [session.send(content_request, **send_settings) for test_thread in range(options.test_threads)]
+            if options.test_threads == 1:  # a single test is run inline, no test thread needed
+                self.performance_output.avg_content = self.time_content(responses[0])
+            else:
+                # retrieves content on the shared test threads, blocks until all are finished
+                content_times = list(test_pool.map(self.time_content, responses))
+                self.performance_output.avg_content = sum(content_times) / len(content_times)
 
     def time_content(self, response):  # for use in content time threads
-        content_start = time.time()
-        response.content
-        content_end = time.time()
-        self.content_times.append(content_end - content_start)
+        content_start = _pc()
+        for chunk in response.iter_content(chunk_size=65536):  # reads the body without buffering all of it
+            pass
+        return _pc() - content_start
 
     def test_all(self):
-        # TCP times call and threading
-        self.tcp_times = []
-        self.tcp_threads = []
-        for test_thread in range(options.test_threads):  # threads to use for testing
-            tcp_t = threading.Thread(target=self.tcp_time)
-            tcp_t.start()
-            self.tcp_threads.append(tcp_t)
-        for thread in self.tcp_threads:  # wait until threads are finished
-            thread.join()
-        self.performance_output['Average TCP Time'] = mean(self.tcp_times)
-
-        # HTTP call and threading
-        self.get_http()
+        # TCP times call and threading, started on the shared test threads without waiting on them
+        tcp_futures = [test_pool.submit(self.tcp_time) for test_thread in range(options.test_threads)]
+
+        # HTTP call and threading, runs on this queue thread while the TCP tests are in flight
+        try:
+            self.get_http()
+        finally:
+            # blocks until the TCP tests are finished, their times are kept even if the HTTP tests failed
+            wait(tcp_futures)
+            tcp_times = [future.result() for future in tcp_futures if future.exception() is None]
+            if tcp_times:
+                self.performance_output.avg_tcp = sum(tcp_times) / len(tcp_times)
+        for future in tcp_futures:
+            future.result()  # re-raises a failed TCP test once the HTTP results are recorded
 
 
 def do_work(hostname):  # function for queue threads, different from threads for performance metrics
     o = TestPerformance(hostname)
-    o.test_all()
-    host_perfs[hostname] = o.performance_output
-
-
-def worker():  # uses do_work() to perform
-    while True:
-        if options.timeout:  # checks to see if timeout used
-            # if specified, exits the script if a queue thread exceeds the timeout
-            try:
-                if z_s + options.timeout < time.time():  # if a thread exceeds the timeout relative to script start time
-                    raise TimeoutError
-            except TimeoutError:
-                print('TimeoutError: exceeded {}s'.format(options.timeout))
-                os._exit(1)
-        h = q.get()  # hostname
-        if h is None:
-            break
-        do_work(h)
-        q.task_done()
+    if o.performance_output.error is None:  # hosts that failed to resolve are reported without testing
+        try:
+            o.test_all()
+        except (OSError, requests.RequestException) as e:  # refused or dropped connections fail only this host
+            o.performance_output.error = '{}: {}'.format(type(e).__name__, e)
+    return o.performance_output
 
 
 def main():
-    global z_s
-    z_s = time.time()  # start time of the script
+    z_s = _pc()  # start time of the script
 
     # Command Line Parser
-    parser = OptionParser()
-    parser.add_option("-i", "--input", dest="hostname_file",
-                      help="input file of hostname(s)")
-    parser.add_option("-t", "--threads", dest="num_threads", default=1,
-                      help="number of threads to use for host testing queue, defaults to only one thread", type=int)
-    parser.add_option("-o", "--timeout", dest="timeout", default=0,
-                      help="set timeout for website queue worker threads", type=int)
-    parser.add_option("-j", "--json", action="store_true", dest="json", default=False,
-                      help="if specified, sets output to json file")
-    parser.add_option("-u", "--user_agent", dest="user_agent", default=False,
-                      help="specify a custom user-agent for requests")
-    parser.add_option("-T", "--tests", dest="test_threads", default=1,
-                      help="amount of threads each testing content load and TCP time, returns average, defaults 1 thread",
-                      type=int)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="hostname_file", required=True,
+                        help="input file of hostname(s)")
+    parser.add_argument("-t", "--threads", dest="num_threads", default=1,
+                        help="number of threads to use for host testing queue, defaults to only one thread", type=int)
+    parser.add_argument("-o", "--timeout", dest="timeout", default=0,
+                        help="set timeout for website queue worker threads", type=int)
+    parser.add_argument("-j", "--json", action="store_true", dest="json", default=False,
+                        help="if specified, sets output to json file")
+    parser.add_argument("-u", "--user_agent", dest="user_agent", default=False,
+                        help="specify a custom user-agent for requests")
+    parser.add_argument("-T", "--tests", dest="test_threads", default=1,
+                        help="amount of threads each testing content load and TCP time, returns average, defaults 1 "
+                             "thread",
+                        type=int)
     global options
-    (options, args) = parser.parse_args()
-
-    global host_perfs
-    host_perfs = {}  # host performances
-    global host_list
-    host_list = []  # list of input host names
-
-    with open(options.hostname_file) as f:  # read input hosts
-        for hostname in f:
-            host_list.append(hostname.rstrip())
-
-    global q
-    q = queue.Queue()  # queue for threads
-    threads = []  # for keeping track of queue threads
-
-    for i in range(options.num_threads):  # begin queue threads and start testing for each host
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
-
-    for item in host_list:
-        q.put(item)
-
-    # block until all queue threads are done
-    q.join()
-
-    # stop queue thread workers
-    for i in range(options.num_threads):
-        q.put(None)
-    for t in threads:
-        t.join()
+    options = parser.parse_args()
+
+    host_list = Path(options.hostname_file).read_text().split()  # list of input host names, one per line
+
+    global dns_map
+    unique_hosts = {}  # duplicate hostnames, however they are spelled, are only resolved once
+    for hostname in host_list:
+        unique_hosts.setdefault(host_key(hostname), hostname)
+    with ThreadPoolExecutor(max_workers=32) as dns_pool:  # overlaps resolver latency of all lookups
+        dns_map = dict(zip(unique_hosts, dns_pool.map(resolve, unique_hosts.values())))
+
+    global test_pool
+    # test threads shared by all hosts, enough for every queue thread to run its TCP and content tests at once
+    test_pool = ThreadPoolExecutor(max_workers=2 * options.num_threads * options.test_threads)
+
+    # queue worker threads are recycled by the pool across hosts instead of one thread per queue slot
+    host_pool = ThreadPoolExecutor(max_workers=options.num_threads)
+    futures = [host_pool.submit(do_work, item) for item in host_list]
+
+    timeout = None
+    if options.timeout:  # checks to see if timeout used, relative to script start time
+        timeout = max(z_s + options.timeout - _pc(), 0)
+    # block until all hosts are done or the timeout is exceeded
+    done, not_done = wait(futures, timeout=timeout)
+    host_pool.shutdown(wait=False, cancel_futures=True)  # hosts not yet started are dropped
+    test_pool.shutdown(wait=False)
+    host_perfs = {}  # host performances, merged on the main thread in input order
+    for hostname, future in zip(host_list, futures):
+        if future not in done:
+            continue
+        error = future.exception()
+        if error is None:
+            host_perfs[hostname] = future.result()
+        else:  # unexpected worker error, the host is skipped and the other results are still reported
+            sys.stderr.write('{}: {}: {}\n'.format(hostname, type(error).__name__, error))
+    if not_done:
+        # results of the hosts that finished are still reported
+        sys.stderr.write('TimeoutError: exceeded {}s\n'.format(options.timeout))
 
     if options.json:
         # format input file name to output file name for json
@@ -207,15 +352,21 @@ def main():
             j_name = ".".join(s_name[:-1])
         else:
             j_name = s_name[0]
-        with open(j_name + '_results.json', 'w') as f:
-            json.dump(host_perfs, f)
+        with open(j_name + '_results.json', 'wb') as f:
+            f.write(json_dumps({name: perfs.to_dict() for name, perfs in host_perfs.items()}))
     else:
-        # prints test results to stdout
-        for name in host_perfs:
-            print(name)
-            for test in host_perfs[name]:
-                print(test, ':', host_perfs[name][test])
-            print()
+        # prints test results to stdout, built up front and written at once
+        lines = []
+        for name, perfs in host_perfs.items():
+            lines.append(name + '\n')
+            lines.extend('{} : {}\n'.format(test, result) for test, result in perfs.to_dict().items())
+            lines.append('\n')
+        sys.stdout.write(''.join(lines))
+
+    if not_done:
+        # timed out workers can't be interrupted, so exit without waiting on them
+        sys.stdout.flush()
+        os._exit(1)
 
 if __name__ == '__main__':
     main()